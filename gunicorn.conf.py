@@ -0,0 +1,27 @@
+# Конфиг gunicorn — подхватывается автоматически из рабочей директории (/app).
+# Параметры запуска (bind, workers, threads, timeout) — в CMD Dockerfile
+import threading
+
+
+def post_worker_init(worker):
+    """Прогрев Whisper в воркере, уже после fork.
+    В master (--preload) грузить нельзя: потоки CTranslate2 не наследуются
+    дочерним процессом и transcribe() в воркере зависает навсегда"""
+    import server
+
+    if server.PRELOAD_WHISPER:
+        # В фоне: загрузка весов не должна держать воркер дольше --timeout
+        threading.Thread(
+            target=server.get_whisper_pipeline, name="whisper-preload", daemon=True
+        ).start()
+
+
+def worker_exit(server, worker):
+    """Остановка воркера: рендеры из очереди отменяем, иначе воркер ждёт их все
+    и gunicorn убивает его по graceful timeout"""
+    import sys
+
+    # Модуль мог не загрузиться (воркер упал на старте) — тогда и пула нет
+    app_module = sys.modules.get("server")
+    if app_module is not None:
+        app_module.shutdown_render_pool()
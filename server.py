@@ -1,26 +1,43 @@
 import os
 import re
-import json
 import uuid
+import hashlib
 import shutil
 import threading
+import time
+import wave
 import logging
 import subprocess
 import tempfile
+from concurrent.futures import ThreadPoolExecutor, wait
 from functools import wraps
 from datetime import datetime, timezone
 from pathlib import Path
 
+import orjson
 import requests
 import yadisk
+from requests.adapters import HTTPAdapter
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
 from supabase import create_client, Client
 
 # ====================================
 # CONFIGURATION
 # ====================================
 
+class ORJSONProvider(JSONProvider):
+    """JSON-провайдер Flask на orjson — используется во всех jsonify и request.get_json"""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -29,32 +46,126 @@ SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_SERVICE_KEY")
 API_KEY = os.environ.get("FLASK_API_KEY")
 ROOT_VIDEOS_DIR = os.environ.get("ROOT_VIDEOS_DIR", "/output/final-videos")
+# Кеш готовых блоков для повторного рендера (ключ — URL ассетов, а не их содержимое:
+# перезалитый по тому же URL файл не попадёт в видео). По умолчанию выключен
+BLOCK_CACHE = os.environ.get("BLOCK_CACHE", "0") == "1"
+BLOCK_CACHE_DIR = os.path.abspath(os.environ.get("BLOCK_CACHE_DIR", os.path.join(ROOT_VIDEOS_DIR, "_cache")))
+BLOCK_CACHE_MAX_AGE_HOURS = float(os.environ.get("BLOCK_CACHE_MAX_AGE_HOURS", 72))
 # Яндекс.Диск
 YANDEX_DISK_TOKEN = os.environ.get("YANDEX_DISK_TOKEN")
 YANDEX_DISK_ROOT_FOLDER = "/YouTubeRAG"
+# Максимум параллельных рендеров глав
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", 2))
+# Максимум принятых рендеров (в работе + в очереди), сверх — 503
+MAX_PENDING_RENDERS = int(os.environ.get("MAX_PENDING_RENDERS", RENDER_WORKERS * 4))
+# FFmpeg: потоков x264 на один процесс и параллельных рендеров блоков
+# (общий пул на все главы — ядра не делятся заново на каждый рендер)
+FFMPEG_THREADS = int(os.environ.get("FFMPEG_THREADS", 2))
+X264_PRESET = os.environ.get("X264_PRESET", "ultrafast")
+# Параллельных скачиваний ассетов на весь сервер (общий пул для всех глав)
+# и размер пула HTTP-соединений
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 16))
+BLOCK_RENDER_WORKERS = int(os.environ.get("BLOCK_RENDER_WORKERS", max(1, (os.cpu_count() or 1) // FFMPEG_THREADS)))
+# С NVENC кодирует один GPU (и число сессий ограничено драйвером) — меньше параллельных рендеров
+NVENC_BLOCK_WORKERS = int(os.environ.get("NVENC_BLOCK_WORKERS", 1))
+# Whisper (auto → cuda если есть GPU, иначе cpu; compute по умолчанию от устройства)
+WHISPER_MODEL = os.environ.get("WHISPER_MODEL", "distil-small.en")
+WHISPER_DEVICE = os.environ.get("WHISPER_DEVICE", "auto")
+WHISPER_COMPUTE_TYPE = os.environ.get("WHISPER_COMPUTE_TYPE")
+# Постоянная папка для весов CTranslate2 (None → кеш HuggingFace)
+WHISPER_MODEL_DIR = os.environ.get("WHISPER_MODEL_DIR")
+# Одна модель обслуживает до RENDER_WORKERS транскрипций параллельно (воркеры
+# внутри CTranslate2), ядра делятся между ними
+WHISPER_WORKERS = int(os.environ.get("WHISPER_WORKERS", RENDER_WORKERS))
+WHISPER_CPU_THREADS = int(os.environ.get(
+    "WHISPER_CPU_THREADS", max(2, (os.cpu_count() or 1) // WHISPER_WORKERS)
+))
+# Размер батча VAD-чанков (0 → 8 на cuda, 4 на cpu)
+WHISPER_BATCH_SIZE = int(os.environ.get("WHISPER_BATCH_SIZE", 0))
+# Грузить Whisper при старте воркера gunicorn (post_worker_init в gunicorn.conf.py).
+# Не в master: потоки CTranslate2 и CUDA не переживают fork
+PRELOAD_WHISPER = os.environ.get("PRELOAD_WHISPER", "1") == "1"
+
+# OpenMP для CTranslate2 — выставляем до импорта faster_whisper/ctranslate2.
+# Под gunicorn запускать с --workers 1 --threads N, иначе пулы OMP конкурируют
+os.environ.setdefault("OMP_NUM_THREADS", str(WHISPER_CPU_THREADS))
+os.environ.setdefault("KMP_AFFINITY", "granularity=fine,compact,1,0")
 
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
-# Семафор — максимум 2 параллельных рендера
-render_semaphore = threading.Semaphore(2)
+# Пул фоновых рендеров — максимум RENDER_WORKERS параллельно, остальные ждут в очереди
+_render_pool = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+# Остановка пула — shutdown_render_pool() (worker_exit в gunicorn.conf.py / __main__)
+# Слоты приёма задач: выполняющиеся + ждущие в очереди пула
+_render_slots = threading.BoundedSemaphore(MAX_PENDING_RENDERS)
+# Запросы к Supabase, которые идут параллельно с основным потоком рендера
+_db_pool = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="db")
+
+# Общий пул скачиваний: потоков не больше, чем соединений в HTTPAdapter ниже,
+# сколько бы глав ни рендерилось параллельно
+_download_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="download")
+
+# HTTP-сессия для скачивания ассетов — keep-alive и повторное использование
+# TCP/TLS-соединений между десятками загрузок главы
+_http = requests.Session()
+_http_adapter = HTTPAdapter(pool_connections=DOWNLOAD_WORKERS, pool_maxsize=DOWNLOAD_WORKERS)
+_http.mount("https://", _http_adapter)
+_http.mount("http://", _http_adapter)
+
+# Пул FFmpeg-рендеров блоков — общий для всех глав, создаётся при первом рендере
+# (размер зависит от проверки NVENC, а она запускает ffmpeg)
+_ffmpeg_pool: ThreadPoolExecutor | None = None
+_ffmpeg_pool_lock = threading.Lock()
 
 # Whisper — грузим один раз (lazy)
 _whisper_model = None
+_whisper_batched = None
+_whisper_device: str | None = None  # cuda|cpu, определяется при загрузке модели
 _whisper_lock = threading.Lock()
 
 
+def _resolve_whisper_device() -> str:
+    """WHISPER_DEVICE=auto → cuda при наличии GPU, иначе cpu"""
+    if WHISPER_DEVICE != "auto":
+        return WHISPER_DEVICE
+    try:
+        import ctranslate2
+        return "cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu"
+    except Exception:
+        return "cpu"
+
+
 def get_whisper_model():
-    global _whisper_model
+    global _whisper_model, _whisper_device
     if _whisper_model is None:
         with _whisper_lock:
             if _whisper_model is None:
                 from faster_whisper import WhisperModel
-                logger.info("[Whisper] Loading model...")
-                _whisper_model = WhisperModel("base", device="cpu", compute_type="int8")
+                device = _whisper_device = _resolve_whisper_device()
+                # int8_float16 на GPU — вдвое меньше VRAM, int8 на CPU
+                compute_type = WHISPER_COMPUTE_TYPE or ("int8_float16" if device == "cuda" else "int8")
+                logger.info(f"[Whisper] Loading model {WHISPER_MODEL} ({device}, {compute_type})...")
+                _whisper_model = WhisperModel(
+                    WHISPER_MODEL, device=device, compute_type=compute_type,
+                    cpu_threads=WHISPER_CPU_THREADS, num_workers=WHISPER_WORKERS,
+                    download_root=WHISPER_MODEL_DIR,
+                )
                 logger.info("[Whisper] ✅ Model loaded")
     return _whisper_model
 
 
+def get_whisper_pipeline():
+    """BatchedInferencePipeline поверх общей модели: VAD-чанки транскрибируются батчами"""
+    global _whisper_batched
+    if _whisper_batched is None:
+        model = get_whisper_model()
+        with _whisper_lock:
+            if _whisper_batched is None:
+                from faster_whisper import BatchedInferencePipeline
+                _whisper_batched = BatchedInferencePipeline(model=model)
+    return _whisper_batched
+
+
 # ====================================
 # YANDEX DISK MANAGER
 # ====================================
@@ -129,15 +240,38 @@ class YandexDiskManager:
 # JOB TRACKING
 # ====================================
 
-_jobs: dict[str, dict] = {}  # job_id → job info
-_jobs_lock = threading.Lock()
+# Кеш ISO-времени: обновление статуса задачи дёргается на каждом шаге рендера,
+# секундной точности для updated_at достаточно
+_ts_cache: list = [0.0, ""]  # [time.time(), iso-строка]
+
+
+def iso_now() -> str:
+    """Текущее время UTC в ISO-формате, пересчитывается не чаще раза в 0.5с"""
+    t = time.time()
+    if t - _ts_cache[0] > 0.5:
+        _ts_cache[:] = [t, datetime.fromtimestamp(t, timezone.utc).isoformat()]
+    return _ts_cache[1]
+
+
+# Шардированное хранилище: замок на шард, а не один на все задачи,
+# чтобы частый опрос /job-status не сериализовал весь сервер
+NSHARDS = 16
+_job_shards: list[tuple[threading.RLock, dict[str, dict]]] = [
+    (threading.RLock(), {}) for _ in range(NSHARDS)
+]  # [(lock, job_id → job info)]
+
+
+def _shard(job_id: str) -> tuple[threading.RLock, dict[str, dict]]:
+    return _job_shards[hash(job_id) % NSHARDS]
 
 
 def create_job(chapter_id: str) -> str:
     """Создаёт новую задачу рендера, возвращает job_id"""
     job_id = str(uuid.uuid4())
-    with _jobs_lock:
-        _jobs[job_id] = {
+    ts = iso_now()
+    lock, jobs = _shard(job_id)
+    with lock:
+        jobs[job_id] = {
             "job_id": job_id,
             "chapter_id": chapter_id,
             "status": "queued",
@@ -145,26 +279,31 @@ def create_job(chapter_id: str) -> str:
             "completed": False,
             "video_url": None,
             "error": None,
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "updated_at": datetime.now(timezone.utc).isoformat(),
+            "created_at": ts,
+            "updated_at": ts,
         }
     logger.info(f"[Job] Created job {job_id} for chapter {chapter_id}")
     return job_id
 
 
-def update_job(job_id: str, **kwargs):
-    """Обновляет поля задачи"""
-    with _jobs_lock:
-        if job_id in _jobs:
-            _jobs[job_id].update(kwargs)
-            _jobs[job_id]["updated_at"] = datetime.now(timezone.utc).isoformat()
+def update_job(job_id: str, updated_at: str | None = None, **kwargs):
+    """Обновляет поля задачи (целиком заменяет dict — читатели видят согласованный снимок).
+    updated_at — готовая метка времени, если она уже посчитана для записи в Supabase"""
+    lock, jobs = _shard(job_id)
+    with lock:
+        if job_id in jobs:
+            jobs[job_id] = {
+                **jobs[job_id], **kwargs,
+                "updated_at": updated_at or iso_now(),
+            }
 
 
 def get_job(job_id: str) -> dict | None:
     """Возвращает копию данных задачи"""
-    with _jobs_lock:
-        job = _jobs.get(job_id)
-        return dict(job) if job else None
+    _, jobs = _shard(job_id)
+    # Без замка: dict задачи не мутируется, только заменяется целиком
+    job = jobs.get(job_id)
+    return dict(job) if job else None
 
 
 # ====================================
@@ -174,13 +313,19 @@ def get_job(job_id: str) -> dict | None:
 def parse_json_field(value):
     """Парсит поле которое может быть JSON-строкой или уже dict"""
     if isinstance(value, str):
-        return json.loads(value)
+        return orjson.loads(value)
     return value or {}
 
 
+_YADISK_RE = re.compile(r'yadi\.sk|disk\.yandex\.(?:ru|com)')
+
+
 def is_yadisk_public_link(url: str) -> bool:
     """Проверяет, является ли URL публичной ссылкой Яндекс.Диска."""
-    return bool(re.search(r'(yadi\.sk|disk\.yandex\.(ru|com))', url))
+    # Быстрый отказ для обычных URL (S3, unsplash и т.д.) без прохода regex
+    if 'yadi.sk' not in url and 'disk.yandex.' not in url:
+        return False
+    return bool(_YADISK_RE.search(url))
 
 
 def get_yadisk_download_url(public_url: str) -> str:
@@ -190,7 +335,7 @@ def get_yadisk_download_url(public_url: str) -> str:
     Возвращает прямой URL для скачивания.
     """
     api_url = "https://cloud-api.yandex.net/v1/disk/public/resources/download"
-    resp = requests.get(api_url, params={"public_key": public_url}, timeout=30)
+    resp = _http.get(api_url, params={"public_key": public_url}, timeout=30)
     resp.raise_for_status()
     data = resp.json()
     href = data.get("href")
@@ -208,33 +353,89 @@ def download_file(url: str, save_path: str) -> str:
         # Яндекс.Диск — получаем прямую ссылку через API
         logger.info(f"[Download] Detected Yandex.Disk public link")
         direct_url = get_yadisk_download_url(url)
-        resp = requests.get(direct_url, stream=True, timeout=120)
+        resp = _http.get(direct_url, stream=True, timeout=120)
         resp.raise_for_status()
     else:
         # Обычный URL (unsplash, S3, и т.д.)
-        resp = requests.get(url, stream=True, timeout=60)
+        resp = _http.get(url, stream=True, timeout=60)
         resp.raise_for_status()
 
-    with open(save_path, 'wb') as f:
-        for chunk in resp.iter_content(chunk_size=8192):
-            f.write(chunk)
+    # Сокет → файл блоками по 1 МБ, без промежуточного bytes на каждые 8 КБ.
+    # decode_content — распаковка gzip/deflate, как делал iter_content
+    with resp, open(save_path, 'wb') as f:
+        resp.raw.decode_content = True
+        shutil.copyfileobj(resp.raw, f, length=1024 * 1024)
 
     file_size = os.path.getsize(save_path)
     logger.info(f"[Download] ✅ Saved {save_path} ({file_size} bytes)")
     return save_path
 
 
-def run_ffmpeg(cmd: list[str], step_name: str):
-    """Запускает FFmpeg/FFprobe, логирует stderr при ошибке"""
-    result = subprocess.run(cmd, capture_output=True, text=True)
+def run_ffmpeg(cmd: list[str], step_name: str, input: str | None = None):
+    """Запускает FFmpeg/FFprobe, логирует stderr при ошибке. input — текст в stdin"""
+    result = subprocess.run(cmd, input=input, capture_output=True, text=True)
     if result.returncode != 0:
         logger.error(f"[{step_name}] FFmpeg stderr:\n{result.stderr}")
         raise subprocess.CalledProcessError(result.returncode, cmd)
     return result
 
 
+# Кеш проверки NVENC
+_nvenc_available: bool | None = None
+
+
+def _has_nvenc_support() -> bool:
+    """Проверяет, может ли FFmpeg кодировать через h264_nvenc (энкодер в сборке + рабочий GPU)"""
+    global _nvenc_available
+    if _nvenc_available is not None:
+        return _nvenc_available
+
+    try:
+        result = subprocess.run(
+            ['ffmpeg', '-hide_banner', '-encoders'],
+            capture_output=True, text=True, timeout=10
+        )
+        _nvenc_available = 'h264_nvenc' in result.stdout
+        if _nvenc_available:
+            # Энкодер есть в сборке всегда — проверяем пробным кадром, что GPU реально доступен
+            probe = subprocess.run(
+                ['ffmpeg', '-hide_banner', '-f', 'lavfi', '-i', 'color=black:s=256x256',
+                 '-frames:v', '1', '-c:v', 'h264_nvenc', '-f', 'null', '-'],
+                capture_output=True, text=True, timeout=30
+            )
+            _nvenc_available = probe.returncode == 0
+        logger.info(f"[Video] FFmpeg NVENC support: {'✅' if _nvenc_available else '❌ (libx264)'}")
+    except Exception:
+        _nvenc_available = False
+
+    return _nvenc_available
+
+
+def _video_encoder_args() -> list[str]:
+    """Параметры видеокодека для зацикленной картинки: h264_nvenc при наличии GPU, иначе libx264"""
+    if _has_nvenc_support():
+        # VBR с целевым качеством: статичная картинка почти ничего не стоит по битрейту
+        return ['-c:v', 'h264_nvenc', '-preset', 'p4', '-tune', 'll', '-rc', 'vbr', '-cq', '23', '-b:v', '0']
+    # Статичная картинка: движения нет, поиск ME на ultrafast почти не тратит CPU
+    return [
+        '-c:v', 'libx264', '-preset', X264_PRESET, '-threads', str(FFMPEG_THREADS),
+        '-tune', 'stillimage', '-sc_threshold', '0',
+    ]
+
+
 def get_audio_duration(audio_path: str) -> float:
-    """Получает длительность аудио через FFprobe"""
+    """Получает длительность аудио: из заголовка WAV, иначе через FFprobe"""
+    # PCM WAV — длительность из заголовка, без запуска процесса
+    try:
+        with wave.open(audio_path, 'rb') as w:
+            nframes, rate = w.getnframes(), w.getframerate()
+        # Потоковый TTS пишет заголовок с размером data = 0 — такому не верим
+        if nframes > 0 and rate > 0:
+            return nframes / float(rate)
+    except (wave.Error, EOFError):
+        pass
+
+    # Не-PCM WAV, пустой размер в заголовке или другой формат под расширением .wav
     cmd = [
         'ffprobe', '-v', 'error',
         '-show_entries', 'format=duration',
@@ -245,30 +446,44 @@ def get_audio_duration(audio_path: str) -> float:
     return float(result.stdout.strip())
 
 
-def create_looped_video_with_audio(image_path: str, audio_path: str, output_path: str, duration: float) -> str:
-    """Создаёт видео: зацикленная картинка + аудио"""
-    logger.info(f"[Video] Creating video ({duration:.1f}s)")
+def _looped_video_cmd(image_path: str, audio_path: str, output_path: str, duration: float,
+                      vf: str | None = None) -> list[str]:
+    """Команда FFmpeg: зацикленная картинка + аудио (+ опционально фильтр -vf)"""
     cmd = [
         'ffmpeg', '-y',
         '-loop', '1', '-i', image_path,
         '-i', audio_path,
-        '-c:v', 'libx264', '-tune', 'stillimage',
-        '-c:a', 'aac', '-b:a', '192k',
+    ]
+    if vf:
+        cmd += ['-vf', vf]
+    cmd += [
+        *_video_encoder_args(),
+        # Одинаковые параметры аудио у всех блоков: WAV могут прийти с разной
+        # частотой/каналами, а concat -c copy требует идентичных потоков
+        '-c:a', 'aac', '-b:a', '192k', '-ar', '48000', '-ac', '2',
         '-pix_fmt', 'yuv420p', '-r', '24',
         '-t', str(duration), '-shortest',
+        # MPEG-TS: склейка блоков через concat -c copy безопасна всегда
+        '-bsf:v', 'h264_mp4toannexb', '-f', 'mpegts',
         output_path
     ]
-    run_ffmpeg(cmd, "Video")
+    return cmd
+
+
+def create_looped_video_with_audio(image_path: str, audio_path: str, output_path: str, duration: float) -> str:
+    """Создаёт видео: зацикленная картинка + аудио"""
+    logger.info(f"[Video] Creating video ({duration:.1f}s)")
+    run_ffmpeg(_looped_video_cmd(image_path, audio_path, output_path, duration), "Video")
     logger.info(f"[Video] ✅ {output_path}")
     return output_path
 
 
 def format_srt_time(seconds: float) -> str:
     """00:01:23,456"""
-    h = int(seconds // 3600)
-    m = int((seconds % 3600) // 60)
-    s = int(seconds % 60)
-    ms = int((seconds - int(seconds)) * 1000)
+    # Целочисленная арифметика по миллисекундам — без повторных float-операций
+    h, rem = divmod(round(seconds * 1000), 3_600_000)
+    m, rem = divmod(rem, 60_000)
+    s, ms = divmod(rem, 1000)
     return f"{h:02d}:{m:02d}:{s:02d},{ms:03d}"
 
 
@@ -276,18 +491,24 @@ def generate_subtitles_srt(audio_path: str, output_srt_path: str) -> bool:
     """Генерирует SRT через Faster Whisper"""
     logger.info(f"[Whisper] Transcribing...")
     try:
-        model = get_whisper_model()
-        segments, _ = model.transcribe(audio_path, language="en")
-
-        srt_lines = []
-        for i, seg in enumerate(segments, start=1):
-            srt_lines.append(
-                f"{i}\n{format_srt_time(seg.start)} --> {format_srt_time(seg.end)}\n{seg.text.strip()}\n"
-            )
+        pipeline = get_whisper_pipeline()
+        # Устройство уже определено при загрузке модели — без опроса CUDA на каждый блок
+        batch_size = WHISPER_BATCH_SIZE or (8 if _whisper_device == "cuda" else 4)
+        # beam_size=1 + VAD: тишина пропускается, качество почти как у beam 5.
+        # without_timestamps=False — иначе батч отдаёт один сегмент на весь VAD-чанк
+        segments, _ = pipeline.transcribe(
+            audio_path, language="en", beam_size=1, batch_size=batch_size,
+            vad_filter=True, vad_parameters={"min_silence_duration_ms": 500},
+            without_timestamps=False,
+        )
 
+        # Пишем сегменты по мере выдачи генератором — без списка всех строк в памяти
         os.makedirs(os.path.dirname(output_srt_path), exist_ok=True)
         with open(output_srt_path, 'w', encoding='utf-8') as f:
-            f.write('\n'.join(srt_lines))
+            for i, seg in enumerate(segments, start=1):
+                f.write(
+                    f"{i}\n{format_srt_time(seg.start)} --> {format_srt_time(seg.end)}\n{seg.text.strip()}\n\n"
+                )
 
         logger.info(f"[Whisper] ✅ {output_srt_path}")
         return True
@@ -296,64 +517,109 @@ def generate_subtitles_srt(audio_path: str, output_srt_path: str) -> bool:
         return False
 
 
-def add_subtitles_to_video(video_path: str, srt_path: str, output_path: str) -> str:
-    """Вшивает субтитры в видео (burn-in).
-    Использует фильтр 'subtitles' (libass). Если libass недоступен —
-    парсит SRT и вшивает через 'drawtext' (всегда встроен в FFmpeg).
+def render_block_oneshot(image_path: str, audio_path: str, srt_path: str | None,
+                         output_path: str, duration: float) -> bool:
+    """Один проход FFmpeg: зацикленная картинка + аудио + вшитые субтитры (burn-in).
+    Пробует фильтр 'subtitles' (libass), затем 'drawtext' (всегда встроен в FFmpeg).
+    Если субтитров нет или оба фильтра упали — кодирует видео без субтитров.
+    Возвращает True, если субтитры вшиты.
     """
-    video_abs = os.path.abspath(video_path)
+    if not srt_path:
+        create_looped_video_with_audio(image_path, audio_path, output_path, duration)
+        return False
+
     srt_abs = os.path.abspath(srt_path)
     output_abs = os.path.abspath(output_path)
 
     if not os.path.exists(srt_abs):
         raise FileNotFoundError(f"Subtitle file not found: {srt_abs}")
 
-    logger.info(f"[Subs] Video: {video_abs}")
+    logger.info(f"[Video] Creating video with subtitles ({duration:.1f}s)")
     logger.info(f"[Subs] SRT: {srt_abs}")
 
-    # ── Сначала пробуем libass (subtitles filter) ──
+    for method, vf in _subtitle_filters(srt_abs):
+        cmd = _looped_video_cmd(image_path, audio_path, output_abs, duration, vf=vf)
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode == 0:
+            logger.info(f"[Subs] ✅ {output_abs} ({method})")
+            return True
+        logger.warning(f"[Subs] {method} failed (code {result.returncode})")
+        logger.warning(f"[Subs] FFmpeg stderr: {result.stderr[-1000:]}")
+
+    # Последний fallback — видео без субтитров
+    logger.warning("[Subs] Subtitle burn-in failed — using video without subtitles")
+    create_looped_video_with_audio(image_path, audio_path, output_path, duration)
+    return False
+
+
+def _subtitle_filters(srt_abs: str) -> list[tuple[str, str]]:
+    """Варианты -vf для субтитров по приоритету: [(method, filter)]"""
+    filters = []
     if _has_libass_support():
-        # FFmpeg subtitles filter (libass) требует экранирования
-        # спецсимволов в пути: \ → /, : → \:, ' → \'
-        srt_escaped = srt_abs.replace('\\', '/').replace(':', '\\:').replace("'", "\\'")
-
-        subtitles_filter = (
-            f"subtitles='{srt_escaped}':force_style='"
-            "FontName=Arial,FontSize=24,PrimaryColour=&H00FFFFFF,"
-            "OutlineColour=&H00000000,BorderStyle=3,Outline=2,Shadow=0,"
-            "MarginV=50,Alignment=2'"
-        )
+        filters.append(("libass", _libass_filter(srt_abs)))
+    else:
+        logger.info("[Subs] Using drawtext fallback")
 
-        cmd = [
-            'ffmpeg', '-y',
-            '-i', video_abs,
-            '-vf', subtitles_filter,
-            '-c:a', 'copy', output_abs
-        ]
+    entries = _parse_srt(srt_abs)
+    if entries:
+        filters.append(("drawtext", _drawtext_filter(entries)))
+    else:
+        logger.warning("[Subs] No subtitle entries found")
+    return filters
 
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode == 0:
-            logger.info(f"[Subs] ✅ {output_abs} (libass)")
-            return output_path
-        else:
-            logger.warning(f"[Subs] libass subtitles filter failed (code {result.returncode}), falling back to drawtext")
-            logger.warning(f"[Subs] FFmpeg stderr: {result.stderr[-500:]}")
 
-    # ── Fallback: drawtext (всегда доступен) ──
-    logger.info("[Subs] Using drawtext fallback")
-    return _burn_subs_drawtext(video_abs, srt_abs, output_abs)
+# Стиль субтитров (входит в ключ кеша блоков — смена стиля не отдаёт старые блоки)
+_LIBASS_STYLE = (
+    "FontName=Arial,FontSize=24,PrimaryColour=&H00FFFFFF,"
+    "OutlineColour=&H00000000,BorderStyle=3,Outline=2,Shadow=0,"
+    "MarginV=50,Alignment=2"
+)
+_DRAWTEXT_STYLE = (
+    ":fontfile=/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+    ":fontsize=24:fontcolor=white"
+    ":borderw=2:bordercolor=black"
+    ":x=(w-text_w)/2:y=h-th-50"
+)
+
 
+def _libass_filter(srt_abs: str) -> str:
+    """Фильтр 'subtitles' (libass)"""
+    # FFmpeg subtitles filter (libass) требует экранирования
+    # спецсимволов в пути: \ → /, : → \:, ' → \'
+    srt_escaped = srt_abs.replace('\\', '/').replace(':', '\\:').replace("'", "\\'")
 
-# Кеш проверки libass
+    return f"subtitles='{srt_escaped}':force_style='{_LIBASS_STYLE}'"
+
+
+# Кеш проверки libass (в памяти + файл рядом с temp, ключ — mtime бинарника ffmpeg)
 _libass_available: bool | None = None
 
 
+def _libass_probe_cache_path() -> str | None:
+    """Путь к файлу с результатом проверки libass для текущего бинарника ffmpeg"""
+    ffmpeg_bin = shutil.which('ffmpeg')
+    if not ffmpeg_bin:
+        return None
+    mtime_ns = os.stat(ffmpeg_bin).st_mtime_ns
+    return os.path.join(tempfile.gettempdir(), f".libass_probe_{mtime_ns}")
+
+
 def _has_libass_support() -> bool:
     """Проверяет, поддерживает ли FFmpeg фильтр subtitles (libass)"""
     global _libass_available
     if _libass_available is not None:
         return _libass_available
 
+    # Результат прошлого запуска с тем же ffmpeg — без `ffmpeg -filters`
+    cache_path = _libass_probe_cache_path()
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r') as f:
+                _libass_available = f.read().strip() == '1'
+            return _libass_available
+        except OSError:
+            pass
+
     try:
         result = subprocess.run(
             ['ffmpeg', '-filters'],
@@ -365,45 +631,51 @@ def _has_libass_support() -> bool:
         else:
             logger.info("[Subs] FFmpeg libass support: ✅")
     except Exception:
+        # Ошибку запуска не кешируем на диск — при следующем старте проверим заново
         _libass_available = False
+        return _libass_available
+
+    if cache_path:
+        try:
+            with open(cache_path, 'w') as f:
+                f.write('1' if _libass_available else '0')
+        except OSError as e:
+            logger.warning(f"[Subs] Failed to cache libass probe: {e}")
 
     return _libass_available
 
 
+# Блок SRT: номер, строка таймкодов, текст до пустой строки или конца файла
+_SRT_RE = re.compile(
+    r'^\d+\n'
+    r'(\d{2}):(\d{2}):(\d{2}),(\d{3})[ \t]*-->[ \t]*(\d{2}):(\d{2}):(\d{2}),(\d{3})\n'
+    r'([^\n].*?)(?=\n\s*\n|\Z)',
+    re.S | re.M
+)
+
+
+def _srt_seconds(m: re.Match, i: int) -> float:
+    """Группы i..i+3 (чч, мм, сс, мс) → секунды"""
+    return int(m.group(i)) * 3600 + int(m.group(i + 1)) * 60 + int(m.group(i + 2)) + int(m.group(i + 3)) / 1000
+
+
 def _parse_srt(srt_path: str) -> list[dict]:
-    """Парсит SRT-файл → список {start, end, text}"""
-    entries = []
+    """Парсит SRT-файл → список {start, end, text} (один проход regex по файлу)"""
     with open(srt_path, 'r', encoding='utf-8') as f:
         content = f.read().strip()
 
-    blocks = re.split(r'\n\s*\n', content)
-    for block in blocks:
-        lines = block.strip().split('\n')
-        if len(lines) < 3:
-            continue
-        time_match = re.match(
-            r'(\d{2}):(\d{2}):(\d{2}),(\d{3})\s*-->\s*(\d{2}):(\d{2}):(\d{2}),(\d{3})',
-            lines[1]
-        )
-        if not time_match:
-            continue
-        g = time_match.groups()
-        start = int(g[0]) * 3600 + int(g[1]) * 60 + int(g[2]) + int(g[3]) / 1000
-        end = int(g[4]) * 3600 + int(g[5]) * 60 + int(g[6]) + int(g[7]) / 1000
-        text = ' '.join(lines[2:]).strip()
-        entries.append({"start": start, "end": end, "text": text})
-
-    return entries
-
+    return [
+        {
+            "start": _srt_seconds(m, 1),
+            "end": _srt_seconds(m, 5),
+            "text": m.group(9).replace('\n', ' ').strip(),
+        }
+        for m in _SRT_RE.finditer(content)
+    ]
 
-def _burn_subs_drawtext(video_path: str, srt_path: str, output_path: str) -> str:
-    """Вшивает субтитры через drawtext фильтры (не требует libass)"""
-    entries = _parse_srt(srt_path)
-    if not entries:
-        logger.warning("[Subs] No subtitle entries found — copying video without subs")
-        shutil.copy2(video_path, output_path)
-        return output_path
 
+def _drawtext_filter(entries: list[dict]) -> str:
+    """Субтитры через drawtext фильтры (не требует libass)"""
     # Формируем drawtext-фильтры для каждой строки субтитров
     drawtext_parts = []
     for entry in entries:
@@ -417,68 +689,140 @@ def _burn_subs_drawtext(video_path: str, srt_path: str, output_path: str) -> str
         dt = (
             f"drawtext=text='{text}'"
             f":enable='between(t,{entry['start']:.3f},{entry['end']:.3f})'"
-            f":fontfile=/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
-            f":fontsize=24:fontcolor=white"
-            f":borderw=2:bordercolor=black"
-            f":x=(w-text_w)/2:y=h-th-50"
+            f"{_DRAWTEXT_STYLE}"
         )
         drawtext_parts.append(dt)
 
     # FFmpeg -vf поддерживает цепочку фильтров через ","
-    vf = ",".join(drawtext_parts)
+    return ",".join(drawtext_parts)
 
-    cmd = [
-        'ffmpeg', '-y',
-        '-i', video_path,
-        '-vf', vf,
-        '-c:a', 'copy', output_path
-    ]
 
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    if result.returncode != 0:
-        logger.error(f"[Subs/drawtext] FFmpeg stderr:\n{result.stderr[-1000:]}")
-        # Последний fallback — копируем видео без субтитров
-        logger.warning("[Subs] drawtext also failed — using video without subtitles")
-        shutil.copy2(video_path, output_path)
-        return output_path
+def concatenate_videos(video_paths: list[str], output_path: str) -> str:
+    """Склеивает MPEG-TS блоки через concat demuxer в MP4 без перекодирования
+    (список файлов — через stdin, без temp-файла)"""
+    logger.info(f"[Concat] Merging {len(video_paths)} videos...")
 
-    logger.info(f"[Subs] ✅ {output_path} (drawtext)")
+    concat_list = "".join(f"file '{vp}'\n" for vp in video_paths)
+    cmd = [
+        'ffmpeg', '-y', '-f', 'concat', '-safe', '0',
+        '-protocol_whitelist', 'pipe,file',
+        '-i', 'pipe:0', '-c', 'copy',
+        # AAC из TS (ADTS) → MP4; moov в начало файла для веба
+        '-bsf:a', 'aac_adtstoasc', '-movflags', '+faststart',
+        output_path
+    ]
+    run_ffmpeg(cmd, "Concat", input=concat_list)
+    logger.info(f"[Concat] ✅ {output_path}")
     return output_path
 
 
-def concatenate_videos(video_paths: list[str], output_path: str) -> str:
-    """Склеивает видео через concat demuxer"""
-    logger.info(f"[Concat] Merging {len(video_paths)} videos...")
+# ====================================
+# BLOCK CACHE
+# ====================================
+
+def block_cache_path(audio_url: str, image_url: str, revision: str = "") -> Path:
+    """Путь к кешу готового блока. Ключ — URL ассетов + revision (updated_at строки
+    script_blocks) + модель Whisper и стиль субтитров + параметры кодека,
+    чтобы склейка -c copy не смешала блоки с разными SPS/PPS"""
+    key_src = "\n".join([
+        audio_url, image_url, revision, WHISPER_MODEL, _LIBASS_STYLE, _DRAWTEXT_STYLE,
+        *_video_encoder_args(),
+    ])
+    key = hashlib.sha256(key_src.encode()).hexdigest()[:16]
+    return Path(BLOCK_CACHE_DIR) / f"{key}.ts"
+
+
+def store_block_in_cache(video_path: str, cache_path: Path):
+    """Кладёт видео блока в кеш (hard link, иначе копия). Ошибки кеша не валят рендер"""
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(video_path, tmp_path)
+        except OSError:
+            # Другая ФС или hard link не поддерживается
+            shutil.copy2(video_path, tmp_path)
+        os.replace(tmp_path, cache_path)
+        logger.info(f"[Cache] ✅ Stored {cache_path}")
+    except Exception as e:
+        logger.warning(f"[Cache] Failed to store {video_path}: {e}")
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
 
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False) as f:
-        for vp in video_paths:
-            f.write(f"file '{vp}'\n")
-        concat_list = f.name
 
+def prune_block_cache():
+    """Удаляет блоки, к которым не обращались дольше BLOCK_CACHE_MAX_AGE_HOURS (mtime = LRU)"""
+    cutoff_ts = time.time() - BLOCK_CACHE_MAX_AGE_HOURS * 3600
+    removed = 0
     try:
-        cmd = [
-            'ffmpeg', '-y', '-f', 'concat', '-safe', '0',
-            '-i', concat_list, '-c', 'copy', output_path
-        ]
-        run_ffmpeg(cmd, "Concat")
-        logger.info(f"[Concat] ✅ {output_path}")
-        return output_path
-    finally:
-        os.unlink(concat_list)
+        with os.scandir(BLOCK_CACHE_DIR) as it:
+            for entry in it:
+                if entry.is_file(follow_symlinks=False) and entry.stat().st_mtime < cutoff_ts:
+                    os.unlink(entry.path)
+                    removed += 1
+    except FileNotFoundError:
+        return
+    except OSError as e:
+        logger.warning(f"[Cache] Prune failed: {e}")
+    if removed:
+        logger.info(f"[Cache] Pruned {removed} stale blocks")
 
 
 # ====================================
 # MAIN RENDER FUNCTION
 # ====================================
 
+def get_ffmpeg_pool() -> ThreadPoolExecutor:
+    """Общий пул рендеров блоков: BLOCK_RENDER_WORKERS, с NVENC — не больше NVENC_BLOCK_WORKERS"""
+    global _ffmpeg_pool
+    if _ffmpeg_pool is None:
+        with _ffmpeg_pool_lock:
+            if _ffmpeg_pool is None:
+                workers = BLOCK_RENDER_WORKERS
+                if _has_nvenc_support():
+                    workers = min(workers, NVENC_BLOCK_WORKERS)
+                _ffmpeg_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ffmpeg")
+    return _ffmpeg_pool
+
+
+def shutdown_render_pool():
+    """Отменяет рендеры из очереди при остановке сервера; запущенные доработают.
+    Вызывать явно до выхода интерпретатора: atexit не успевает — concurrent.futures
+    джойнит потоки пула раньше atexit-хуков, и очередь успела бы отработать целиком"""
+    _render_pool.shutdown(wait=False, cancel_futures=True)
+    logger.info("[RENDER] Pool shut down, queued renders cancelled")
+
+
+def render_block(block: dict) -> str:
+    """Рендер одного блока одним проходом FFmpeg: картинка+аудио+субтитры. Возвращает путь к видео"""
+    srt_path = block["srt_path"] if block["subs_ok"] and os.path.exists(block["srt_path"]) else None
+    subs_burned = render_block_oneshot(
+        block["image_path"], block["audio_path"], srt_path, block["final_video"], block["duration"]
+    )
+    # Без субтитров (сбой Whisper или burn-in) не кешируем — при повторе попробуем снова
+    if block["cache_path"] and subs_burned:
+        store_block_in_cache(block["final_video"], block["cache_path"])
+    # Исходники блока больше не нужны — освобождаем место сразу, не дожидаясь rmtree
+    for path in (block["audio_path"], block["image_path"], block["srt_path"]):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    logger.info(f"[Block {block['seq']}] ✅ Done")
+    return block["final_video"]
+
+
 def render_chapter_task(chapter_id: str, job_id: str):
     """
     Фоновая задача: рендер одной главы.
     1. Берёт данные главы и её script_blocks из Supabase
-    2. Для каждого блока: скачивает картинку+аудио → видео → субтитры
-    3. Склеивает все блоки в один chapter_{number}.mp4
-    4. Загружает финальное видео на Яндекс.Диск
-    5. Удаляет локальный финальный файл после успешной загрузки
+    2. Скачивает картинки+аудио всех блоков (готовые блоки берёт из кеша)
+    3. Субтитры Whisper для всех блоков, параллельно — видео блоков с субтитрами (один проход FFmpeg)
+    4. Склеивает все блоки в один chapter_{number}.mp4
+    5. Загружает финальное видео на Яндекс.Диск
+    6. Удаляет локальный финальный файл после успешной загрузки
     """
 
     logger.info(f"\n{'='*60}")
@@ -487,6 +831,15 @@ def render_chapter_task(chapter_id: str, job_id: str):
 
     update_job(job_id, status="in_progress", stage="Fetching chapter data")
 
+    # script_blocks не зависят от строки главы — запрашиваем параллельно с ней
+    blocks_future = _db_pool.submit(
+        lambda: supabase.table("script_blocks")
+        .select("*")
+        .eq("chapter_id", chapter_id)
+        .order("sequence_number")
+        .execute()
+    )
+
     # ── Получаем данные главы ──
     try:
         chapter_resp = supabase.table("chapters") \
@@ -505,27 +858,8 @@ def render_chapter_task(chapter_id: str, job_id: str):
 
     logger.info(f"[RENDER] Project: {project_id}, Chapter #{chapter_number}")
 
-    # ── Ставим статус "rendering" ──
-    try:
-        supabase.table("chapters").update({
-            "status": "rendering",
-            "updated_at": datetime.now(timezone.utc).isoformat()
-        }).eq("id", chapter_id).execute()
-    except Exception as e:
-        logger.error(f"[DB] Failed to set rendering status: {e}")
-        update_job(job_id, status="failed", stage="Failed to update DB status", error=str(e))
-        return
-
-    # ── Семафор ──
-    update_job(job_id, stage="Waiting for render slot")
-    acquired = render_semaphore.acquire(timeout=300)
-    if not acquired:
-        logger.error("[RENDER] Semaphore timeout — too many concurrent renders")
-        supabase.table("chapters").update({
-            "status": "failed", "updated_at": datetime.now(timezone.utc).isoformat()
-        }).eq("id", chapter_id).execute()
-        update_job(job_id, status="failed", stage="Semaphore timeout", error="Too many concurrent renders")
-        return
+    # Промежуточный статус "rendering" живёт только в задаче (/job-status),
+    # в Supabase пишем лишь итог — на один HTTPS round-trip меньше
 
     # Пути
     root_dir = Path(ROOT_VIDEOS_DIR).resolve()
@@ -540,11 +874,7 @@ def render_chapter_task(chapter_id: str, job_id: str):
 
         update_job(job_id, status="rendering", stage="Fetching script blocks")
         logger.info("[DB] Fetching script_blocks...")
-        resp = supabase.table("script_blocks") \
-            .select("*") \
-            .eq("chapter_id", chapter_id) \
-            .order("sequence_number") \
-            .execute()
+        resp = blocks_future.result()
 
         blocks = resp.data
         if not blocks:
@@ -554,18 +884,16 @@ def render_chapter_task(chapter_id: str, job_id: str):
         total_blocks = len(blocks)
 
         # ========================================
-        # STEP 2: Обработка каждого блока
+        # STEP 2: Скачивание ассетов всех блоков
         # ========================================
 
-        processed_videos = []
+        prepared = []  # блоки с локальными файлами, в порядке sequence_number
+        download_jobs = []  # (url, local_path) для всех блоков
 
         for block in blocks:
             seq = block['sequence_number']
             assets = parse_json_field(block.get('assets'))
 
-            update_job(job_id, stage=f"Rendering block {seq}/{total_blocks}")
-            logger.info(f"\n[Block {seq}] Processing...")
-
             audio_url = assets.get('audio_url')
             image_url = assets.get('image_url')
 
@@ -573,50 +901,93 @@ def render_chapter_task(chapter_id: str, job_id: str):
                 logger.error(f"[Block {seq}] ❌ Missing audio_url or image_url — skipping")
                 continue
 
+            # ── Готовый блок из кеша: без скачивания, Whisper и FFmpeg ──
+            cache_path = (
+                block_cache_path(audio_url, image_url, str(block.get('updated_at') or ''))
+                if BLOCK_CACHE else None
+            )
+            if cache_path and cache_path.exists():
+                os.utime(cache_path)  # LRU: свежий mtime — не попадёт под prune
+                logger.info(f"[Block {seq}] ♻️ Cache hit: {cache_path}")
+                prepared.append({"seq": seq, "video": str(cache_path)})
+                continue
+
             # Папка блока: temp_scripts/block_{seq}
             block_dir = temp_dir / f"block_{seq}"
             block_dir.mkdir(parents=True, exist_ok=True)
 
-            # ── Скачиваем файлы ──
-            audio_path = str((block_dir / "audio.wav").resolve())
-            image_path = str((block_dir / "image.png").resolve())
+            # root_dir уже resolve() — пути блока абсолютные, без лишних stat/readlink
+            block_prefix = str(block_dir)
+            audio_path = f"{block_prefix}/audio.wav"
+            image_path = f"{block_prefix}/image.png"
+            download_jobs += [(audio_url, audio_path), (image_url, image_path)]
+
+            prepared.append({
+                "seq": seq,
+                "audio_path": audio_path,
+                "image_path": image_path,
+                "srt_path": f"{block_prefix}/subs.srt",
+                "final_video": f"{block_prefix}/final.ts",
+                "cache_path": cache_path,
+            })
+
+        if not prepared:
+            raise ValueError("No blocks were processed successfully")
 
-            download_file(audio_url, audio_path)
-            download_file(image_url, image_path)
+        pending = [b for b in prepared if "video" not in b]  # блоки, которых нет в кеше
 
-            logger.info(f"[Block {seq}] Audio exists: {os.path.exists(audio_path)}")
-            logger.info(f"[Block {seq}] Image exists: {os.path.exists(image_path)}")
-            logger.info(f"[Block {seq}] Audio path: {audio_path}")
-            logger.info(f"[Block {seq}] Image path: {image_path}")
+        # ── Скачиваем файлы всех блоков параллельно (I/O-bound, потоки ждут сеть) ──
+        update_job(job_id, stage=f"Downloading assets for {len(pending)} blocks")
+        download_futures = [_download_pool.submit(download_file, *job) for job in download_jobs]
+        try:
+            for future in download_futures:
+                future.result()
+        except Exception:
+            # Как с пулом FFmpeg: не качаем дальше в temp_dir упавшей главы
+            for future in download_futures:
+                future.cancel()
+            wait(download_futures)
+            raise
+
+        for b in pending:
+            seq = b['seq']
+            # download_file либо сохранил файл, либо бросил исключение — проверка exists не нужна
+            logger.debug(f"[Block {seq}] Audio path: {b['audio_path']}")
+            logger.debug(f"[Block {seq}] Image path: {b['image_path']}")
 
             # ── Определяем длительность аудио ──
-            duration = get_audio_duration(audio_path)
-            logger.info(f"[Block {seq}] Audio duration: {duration:.1f}s")
-
-            # ── Создаём видео (картинка + аудио) ──
-            raw_video = str((block_dir / "raw.mp4").resolve())
-            create_looped_video_with_audio(image_path, audio_path, raw_video, duration)
-
-            # ── Субтитры через Whisper ──
-            update_job(job_id, stage=f"Generating subtitles for block {seq}/{total_blocks}")
-            srt_path = str((block_dir / "subs.srt").resolve())
-            subs_ok = generate_subtitles_srt(audio_path, srt_path)
-
-            # ── Вшиваем субтитры (или берём без них) ──
-            if subs_ok and os.path.exists(srt_path):
-                final_block_video = str((block_dir / "final.mp4").resolve())
-                add_subtitles_to_video(raw_video, srt_path, final_block_video)
-                processed_videos.append(final_block_video)
-            else:
-                processed_videos.append(raw_video)
+            b["duration"] = get_audio_duration(b["audio_path"])
+            logger.info(f"[Block {seq}] Audio duration: {b['duration']:.1f}s")
+
+        # ========================================
+        # STEP 3: Субтитры всех блоков + видео блоков
+        # ========================================
+        # Whisper идёт одним проходом по всем блокам (модель «горячая»),
+        # а блок с готовыми субтитрами сразу уходит в пул FFmpeg
 
-            logger.info(f"[Block {seq}] ✅ Done")
+        ffmpeg_pool = get_ffmpeg_pool()
+        render_futures = []
+        try:
+            for b in pending:
+                update_job(job_id, stage=f"Generating subtitles for block {b['seq']}/{total_blocks}")
+                b["subs_ok"] = generate_subtitles_srt(b["audio_path"], b["srt_path"])
+                render_futures.append(ffmpeg_pool.submit(render_block, b))
+
+            update_job(job_id, stage="Rendering block videos")
+            for b, future in zip(pending, render_futures):
+                b["video"] = future.result()
+        except Exception:
+            # Пул общий — снимаем из очереди блоки упавшей главы и ждём уже
+            # запущенные, чтобы rmtree(temp_dir) не шёл под работающим ffmpeg
+            for future in render_futures:
+                future.cancel()
+            wait(render_futures)
+            raise
 
-        if not processed_videos:
-            raise ValueError("No blocks were processed successfully")
+        processed_videos = [b["video"] for b in prepared]
 
         # ========================================
-        # STEP 3: Склейка всех блоков в главу
+        # STEP 4: Склейка всех блоков в главу
         # ========================================
 
         update_job(job_id, stage="Concatenating blocks into final video")
@@ -625,7 +996,7 @@ def render_chapter_task(chapter_id: str, job_id: str):
         concatenate_videos(processed_videos, final_path)
 
         # ========================================
-        # STEP 4: Загрузка на Яндекс.Диск
+        # STEP 5: Загрузка на Яндекс.Диск
         # ========================================
 
         update_job(job_id, status="uploading", stage="Uploading to Yandex.Disk")
@@ -662,13 +1033,15 @@ def render_chapter_task(chapter_id: str, job_id: str):
                     update_job(job_id, stage=f"Yandex.Disk upload failed: {upload_result}")
 
         # ========================================
-        # STEP 5: Обновление статуса
+        # STEP 6: Обновление статуса
         # ========================================
 
+        # Одна метка времени на итог — в Supabase и в задаче совпадает
+        ts = iso_now()
         chapter_update = {
             "status": "rendered",
             "video_url": yadisk_url or final_path,
-            "updated_at": datetime.now(timezone.utc).isoformat()
+            "updated_at": ts
         }
         supabase.table("chapters").update(chapter_update).eq("id", chapter_id).execute()
 
@@ -678,6 +1051,7 @@ def render_chapter_task(chapter_id: str, job_id: str):
             stage="Done",
             completed=True,
             video_url=yadisk_url or final_path,
+            updated_at=ts,
         )
 
         logger.info(f"\n{'='*60}")
@@ -686,17 +1060,16 @@ def render_chapter_task(chapter_id: str, job_id: str):
 
     except Exception as e:
         logger.error(f"[RENDER] ❌ ERROR: {e}", exc_info=True)
-        update_job(job_id, status="failed", stage="Render failed", error=str(e))
+        ts = iso_now()
+        update_job(job_id, status="failed", stage="Render failed", error=str(e), updated_at=ts)
         try:
             supabase.table("chapters").update({
-                "status": "failed", "updated_at": datetime.now(timezone.utc).isoformat()
+                "status": "failed", "updated_at": ts
             }).eq("id", chapter_id).execute()
         except Exception:
             logger.error("[DB] Failed to update status to 'failed'", exc_info=True)
 
     finally:
-        render_semaphore.release()
-
         # Чистим temp_scripts
         if temp_dir.exists():
             try:
@@ -705,6 +1078,10 @@ def render_chapter_task(chapter_id: str, job_id: str):
             except Exception as e:
                 logger.warning(f"[Cleanup] Failed: {e}")
 
+        # Кеш блоков лежит вне temp_scripts — чистим только устаревшее
+        if BLOCK_CACHE:
+            prune_block_cache()
+
 
 # ====================================
 # FLASK ROUTES
@@ -729,6 +1106,7 @@ def render_chapter():
     Body: { "chapter_id": "uuid" }
 
     Response 202: { status, message, chapter_id, job_id }
+    Response 503: очередь рендеров заполнена (заголовок Retry-After)
     """
     try:
         data = request.get_json(silent=True)
@@ -739,16 +1117,23 @@ def render_chapter():
         if not chapter_id:
             return jsonify({"error": "Missing chapter_id"}), 400
 
+        # Очередь полна — сразу 503, а не держим соединение в ожидании слота
+        if not _render_slots.acquire(blocking=False):
+            logger.warning(f"[API] Render queue full — rejecting chapter {chapter_id}")
+            return jsonify({"error": "Render queue is full, retry later"}), 503, {"Retry-After": "60"}
+
         # Создаём уникальный ID задачи
         job_id = create_job(chapter_id)
 
-        # Фоновый рендер
-        thread = threading.Thread(
-            target=render_chapter_task,
-            args=(chapter_id, job_id),
-            daemon=True
-        )
-        thread.start()
+        # Фоновый рендер (задача ждёт в очереди пула, пока статус "queued")
+        try:
+            future = _render_pool.submit(render_chapter_task, chapter_id, job_id)
+        except Exception as e:
+            _render_slots.release()
+            # Иначе задача навсегда останется "queued" в /job-status
+            update_job(job_id, status="failed", stage="Failed to queue render", error=str(e))
+            raise
+        future.add_done_callback(lambda _: _render_slots.release())
 
         logger.info(f"[API] Render started for chapter {chapter_id}, job {job_id}")
 
@@ -796,4 +1181,7 @@ def health():
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5055))
-    app.run(host='0.0.0.0', port=port, debug=False)
+    try:
+        app.run(host='0.0.0.0', port=port, debug=False)
+    finally:
+        shutdown_render_pool()